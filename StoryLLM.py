@@ -2,13 +2,23 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import tiktoken
 from datasets import load_dataset
 import matplotlib.pyplot as plt
 import numpy as np
 from datetime import datetime
+import itertools
+import math
 import os
 
+# Allow TF32 tensor cores for FP32 matmuls and let cuDNN autotune the
+# fastest kernels for our fixed shapes
+torch.set_float32_matmul_precision('high')
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+
 # Define hyperparameters
 vocab_size = 50257
 n_heads = 8
@@ -44,131 +54,138 @@ print(f"Test size: {len(test_dataset)}")
 # Initialize the tiktoken encoder
 enc = tiktoken.get_encoding("gpt2")
 
-# Define the tokenization function
-def tokenize_function(examples):
-    return {
-        "input_ids": [enc.encode(text) for text in examples["text"]],
-        "attention_mask": [[1] * len(enc.encode(text)) for text in examples["text"]]
-    }
-
-# Function to pad or truncate sequences
-def pad_or_truncate(batch):
-    max_length = 512
-    for key in ['input_ids', 'attention_mask']:
-        batch[key] = [
-            seq[:max_length] + [0] * (max_length - len(seq)) if len(seq) < max_length else seq[:max_length]
-            for seq in batch[key]
-        ]
-    return batch
-
-# Tokenize and process the datasets
-def process_dataset(dataset, split_name):
-    # Tokenize
-    tokenized_dataset = dataset.map(
-        tokenize_function,
-        batched=True,
-        num_proc=20,
-        remove_columns=dataset.column_names
-    )
-
-    # Pad or truncate
-    processed_dataset = tokenized_dataset.map(
-        pad_or_truncate,
-        batched=True,
-        num_proc=20,
-    )
-
-    # Set format to PyTorch tensors
-    processed_dataset.set_format(type="torch", columns=["input_ids", "attention_mask"])
-
-    return processed_dataset
-
-# Process both train and test datasets
-train_dataset = process_dataset(train_dataset, "train")
-test_dataset = process_dataset(test_dataset, "test")
-
-# Print some examples
-print(f"Example train data: {train_dataset[0]}")
-print(f"Example test data: {test_dataset[0]}")
-
-# Create DataLoaders
-train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=8, shuffle=True)
-test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=8, shuffle=False)
+# One-time pass: encode every text exactly once and pack all token ids
+# into a flat uint16 stream on disk (the GPT-2 vocab fits in 16 bits).
+# encode_ordinary_batch releases the GIL and tokenizes each batch in
+# parallel Rust worker threads
+def write_token_file(dataset, path, batch_size=1024):
+    if not os.path.exists(path):
+        # Write to a temp file and rename into place on completion, so a
+        # run that dies mid-write never leaves a truncated token file
+        # that later runs would silently train on
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for start in range(0, len(dataset), batch_size):
+                texts = dataset[start:start + batch_size]["text"]
+                ids = enc.encode_ordinary_batch(texts, num_threads=8)
+                np.fromiter(itertools.chain.from_iterable(ids), dtype=np.uint16).tofile(f)
+        os.replace(tmp_path, path)
+    if os.path.getsize(path) == 0:
+        raise ValueError(f"Token file {path} is empty — the dataset produced no tokens")
+    return np.memmap(path, dtype=np.uint16, mode="r")
+
+train_tokens = write_token_file(train_dataset, "train.bin")
+test_tokens = write_token_file(test_dataset, "test.bin")
+
+# Print the size of the token streams
+print(f"Train tokens: {len(train_tokens)}")
+print(f"Test tokens: {len(test_tokens)}")
+
+# The memmapped token stream is packed into non-overlapping
+# block_size+1 chunks; targets are the same chunk shifted by one, so
+# there is no padding and every token position is a real supervised
+# prediction. Shuffling the chunk indices covers each token exactly
+# once per epoch.
+class TokenWindowDataset(torch.utils.data.Dataset):
+    def __init__(self, tokens, block_size):
+        self.tokens = tokens
+        self.block_size = block_size
 
-# Print an example batch
-for batch in train_loader:
-    print(f"Batch input ids shape: {batch['input_ids'].shape}")
-    print(f"Batch attention mask shape: {batch['attention_mask'].shape}")
-    break
+    def __len__(self):
+        return len(self.tokens) // (self.block_size + 1)
+
+    def __getitem__(self, idx):
+        start = idx * (self.block_size + 1)
+        window = self.tokens[start:start + self.block_size + 1]
+        return {"input_ids": torch.from_numpy(window.astype(np.int64))}
+
+train_dataset = TokenWindowDataset(train_tokens, block_size)
+test_dataset = TokenWindowDataset(test_tokens, block_size)
+
+# Create DataLoaders; workers slice and collate batches off the
+# training thread, and pinned memory enables async H2D copies
+train_loader = torch.utils.data.DataLoader(
+    train_dataset, batch_size=8, shuffle=True,
+    num_workers=4, pin_memory=True, persistent_workers=True, prefetch_factor=4,
+)
+test_loader = torch.utils.data.DataLoader(
+    test_dataset, batch_size=8, shuffle=False,
+    num_workers=4, pin_memory=True, persistent_workers=True, prefetch_factor=4,
+)
 
 # Print an example batch
 for batch in train_loader:
     print(f"Batch input ids shape: {batch['input_ids'].shape}")
-    print(f"Batch attention mask shape: {batch['attention_mask'].shape}")
     break
 
 # Define model
-class Head(nn.Module):
-    """ One head of self-attention """
-    def __init__(self, head_size, n_embd, block_size, dropout):
-        super().__init__()
-        self.key = nn.Linear(n_embd, head_size, bias=False)
-        self.query = nn.Linear(n_embd, head_size, bias=False)
-        self.value = nn.Linear(n_embd, head_size, bias=False)
-        self.register_buffer("tril", torch.tril(torch.ones(block_size, block_size)))
+class RMSNorm(nn.Module):
+    """ RMS normalization: like LayerNorm but without the mean subtraction """
 
-        self.dropout = nn.Dropout(dropout)
+    def __init__(self, dim, eps=1e-6):
+        super().__init__()
+        self.weight = nn.Parameter(torch.ones(dim))
+        self.eps = eps
 
     def forward(self, x):
-        B, T, C = x.shape
-        k = self.key(x)
-        q = self.query(x)
-        v = self.value(x)
-
-        assert C == self.key.in_features, f"Input size {C} doesn't match expected size {self.key.in_features}"
-
-        wei = q @ k.transpose(-2, -1) * k.shape[-1]**-0.5
-        wei = wei.masked_fill(self.tril[:T, :T] == 0, float('-inf'))
-        wei = F.softmax(wei, dim=-1)
-        wei = self.dropout(wei)
-
-        out = wei @ v
-        return out
+        return F.rms_norm(x, (x.shape[-1],), self.weight, self.eps)
 
 class MultiHeadAttention(nn.Module):
-    """ Multiple heads of self-attention in parallel """
+    """ Multiple heads of self-attention computed in a single fused pass """
 
     def __init__(self, n_heads, head_size, n_embd, dropout):
         super().__init__()
-        self.heads = nn.ModuleList([Head(head_size, n_embd, block_size, dropout) for _ in range(n_heads)])
-        self.proj = nn.Linear(n_heads *  head_size, n_embd)
+        self.n_heads = n_heads
+        self.head_size = head_size
+        # One projection produces Q, K and V for all heads in a single GEMM
+        self.qkv = nn.Linear(n_embd, 3 * n_embd, bias=False)
+        self.proj = nn.Linear(n_heads * head_size, n_embd)
+        self.proj._is_residual_proj = True
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x):
-        # Collects the outputs from each head
-        head_outputs = [head(x) for head in self.heads]
-        # Concatenate the outputs
-        concatenated = torch.cat(head_outputs, dim=-1)
-        # Apply linear transformation and dropout
-        out = self.proj(concatenated)
-        out = self.dropout(out)
-        return out
+    def forward(self, x, past_kv=None, use_cache=False):
+        B, T, C = x.shape
+        # Project to Q/K/V and split into heads: (B, n_heads, T, head_size)
+        qkv = self.qkv(x).view(B, T, 3, self.n_heads, self.head_size).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        # During incremental decoding, append the new K/V to the cache;
+        # the single new query attends to everything, so no causal mask
+        # is needed on that path
+        if past_kv is not None:
+            assert T == 1, f"KV-cached attention expects one new token at a time, got {T}"
+            past_k, past_v = past_kv
+            k = torch.cat((past_k, k), dim=2)
+            v = torch.cat((past_v, v), dim=2)
+        # Fused scaled-dot-product attention with an implicit causal mask
+        out = F.scaled_dot_product_attention(
+            q, k, v,
+            dropout_p=self.dropout.p if self.training else 0.0,
+            is_causal=past_kv is None,
+        )
+        # Merge heads back together
+        out = out.transpose(1, 2).reshape(B, T, C)
+        # Single expression so Inductor can fuse proj's epilogue with
+        # the dropout and the residual add in Block.forward. K/V are
+        # only returned when caching, so training doesn't keep them
+        # alive as checkpoint outputs
+        return self.dropout(self.proj(out)), ((k, v) if use_cache else None)
 
 
 class FeedForward(nn.Module):
-    """ A simple linear layer followed by non-linearity """
+    """ SwiGLU feed-forward: gated silu activation between two projections """
 
     def __init__(self, n_embd, dropout=0.1, expansion_factor=4):
         super().__init__()
-        self.net = nn.Sequential(
-            nn.Linear(n_embd, expansion_factor * n_embd),
-            nn.ReLU(),
-            nn.Linear(expansion_factor * n_embd, n_embd),
-            nn.Dropout(dropout),
-        )
+        # Gate and up projections fused into one GEMM
+        self.w_gate_up = nn.Linear(n_embd, 2 * expansion_factor * n_embd, bias=False)
+        self.w_down = nn.Linear(expansion_factor * n_embd, n_embd, bias=False)
+        self.w_down._is_residual_proj = True
+        self.drop = nn.Dropout(dropout)
 
     def forward(self, x):
-        return self.net(x)
+        gate, up = self.w_gate_up(x).chunk(2, dim=-1)
+        # silu(gate) * up is pointwise, so it fuses with the down projection
+        return self.drop(self.w_down(F.silu(gate) * up))
 
 class Block(nn.Module):
     """ Transformer block: communication followed by computation """
@@ -179,52 +196,77 @@ class Block(nn.Module):
         head_size = n_embd // n_head
         self.sa = MultiHeadAttention(n_head, head_size, n_embd, dropout)
         self.ffwd = FeedForward(n_embd, dropout)
-        self.ln1 = nn.LayerNorm(n_embd)
-        self.ln2 = nn.LayerNorm(n_embd)
+        self.ln1 = RMSNorm(n_embd)
+        self.ln2 = RMSNorm(n_embd)
 
-    def forward(self, x):
-        x = x + self.sa(self.ln1(x))
+    def forward(self, x, past_kv=None, use_cache=False):
+        attn_out, new_kv = self.sa(self.ln1(x), past_kv, use_cache)
+        x = x + attn_out
         x = x + self.ffwd(self.ln2(x))
-        return x
+        return x, new_kv
 
 class GPTLanguageModel(nn.Module):
     def __init__(self, vocab_size, n_embd, block_size, n_layer, n_head, device="cpu"):
         super().__init__()
         self.device = device
         self.block_size = block_size
+        self.n_layer = n_layer
         self.token_embedding_table = nn.Embedding(vocab_size, n_embd)
         self.position_embedding_table = nn.Embedding(block_size, n_embd)
-        self.blocks = nn.Sequential(*[Block(n_embd, n_head) for _ in range(n_layer)])
-        self.ln_f = nn.LayerNorm(n_embd)
-        self.lm_head = nn.Linear(n_embd, vocab_size)
+        self.blocks = nn.ModuleList([Block(n_embd, n_head) for _ in range(n_layer)])
+        self.ln_f = RMSNorm(n_embd)
+        self.lm_head = nn.Linear(n_embd, vocab_size, bias=False)
+        # Position indices cached on device so forward never allocates them
+        self.register_buffer('pos_ids', torch.arange(block_size), persistent=False)
         self.apply(self._init_weights)
+        # Tie input embedding and output head (GPT-2 style); done after
+        # init so both share the embedding's weights. Halves the model's
+        # largest parameter block and its optimizer state.
+        self.lm_head.weight = self.token_embedding_table.weight
 
     def _init_weights(self, module):
-        if isinstance(module, nn.Linear):
-            nn.init.normal_(module.weight, mean=0.0, std=0.02)
-            if module.bias is not None:
+        if isinstance(module, (nn.Linear, nn.Embedding)):
+            std = 0.02
+            # Scale residual-path projections down so the residual
+            # stream's variance stays bounded as depth grows (GPT-2 init)
+            if getattr(module, '_is_residual_proj', False):
+                std = 0.02 / math.sqrt(2 * self.n_layer)
+            nn.init.trunc_normal_(module.weight, mean=0.0, std=std)
+            if isinstance(module, nn.Linear) and module.bias is not None:
                 nn.init.zeros_(module.bias)
-        elif isinstance(module, nn.Embedding):
-            nn.init.normal_(module.weight, mean=0.1, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, past_kvs=None):
         B, T = idx.shape
 
         # Truncate sequence length to block_size
         T = min(T, self.block_size)
         idx = idx[:, :T]
 
+        # During incremental decoding, positions continue from the cache
+        past_len = 0 if past_kvs is None or past_kvs[0] is None else past_kvs[0][0].shape[2]
+
         # Get token embeddings for input indices
         tok_emb = self.token_embedding_table(idx)  # (B, T, C)
 
-        # Get position embeddings (truncate to match input length)
-        pos_emb = self.position_embedding_table(torch.arange(T, device=idx.device))  # (T, C)
+        # Get position embeddings (offset past the cached positions)
+        pos_emb = self.position_embedding_table(self.pos_ids[past_len:past_len + T])  # (T, C)
 
         # Combine token and position embeddings
         x = tok_emb + pos_emb.unsqueeze(0)  # (B, T, C)
 
-        # Apply transformer blocks
-        x = self.blocks(x)  # (B, T, C)
+        # Apply transformer blocks, collecting each layer's K/V only on
+        # the cache path. During training each block is checkpointed:
+        # activations are recomputed on backward, trading one extra
+        # forward per block for ~n_layer times less activation memory
+        use_cache = past_kvs is not None
+        new_kvs = []
+        for block, past_kv in zip(self.blocks, past_kvs if use_cache else [None] * len(self.blocks)):
+            if self.training:
+                x, kv = checkpoint(block, x, past_kv, use_cache, use_reentrant=False)
+            else:
+                x, kv = block(x, past_kv, use_cache)
+            if use_cache:
+                new_kvs.append(kv)
 
         # Final layer normalization
         x = self.ln_f(x)  # (B, T, C)
@@ -237,22 +279,35 @@ class GPTLanguageModel(nn.Module):
         if targets is not None:
             # Ensure targets are the same size as logits
             targets = targets[:, :T]
-            B, T, C = logits.shape
-            logits = logits.reshape(B*T, C)
-            targets = targets.reshape(B*T)
-            loss = F.cross_entropy(logits, targets)
+            # view instead of reshape: flattening the contiguous logits
+            # must never copy the (B, T, vocab_size) tensor
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1))
 
-        return logits, loss
+        if past_kvs is None:
+            return logits, loss
+        return logits, loss, new_kvs
 
     @torch.no_grad()
     def generate(self, idx, max_new_tokens):
+        # Keep a per-layer K/V cache so each step only runs the model on
+        # the newest token instead of re-attending over the whole window
+        past_kvs = [None] * len(self.blocks)
+        idx_cond = idx[:, -self.block_size:]  # Crop the prompt to block_size tokens
         for _ in range(max_new_tokens):
-            idx_cond = idx[:, -self.block_size:]  # Crop to the last block_size tokens
-            logits, _ = self(idx_cond)  # Get Predictions
+            logits, _, past_kvs = self(idx_cond, past_kvs=past_kvs)  # Get Predictions
             logits = logits[:, -1, :]  # Focus on the last time step
             probs = F.softmax(logits, dim=-1)  # Get probabilities
             idx_next = torch.multinomial(probs, num_samples=1)  # Samples from the distribution
             idx = torch.cat((idx, idx_next), dim=1)  # Append sampled index
+            if past_kvs[0][0].shape[2] >= self.block_size:
+                # Cache full: rebuild it by re-encoding the last window
+                # with positions reassigned from 0, the layout the model
+                # was trained on (trimming cached K/V would leave stale
+                # absolute positions behind)
+                past_kvs = [None] * len(self.blocks)
+                idx_cond = idx[:, -self.block_size:]
+            else:
+                idx_cond = idx_next  # Only the new token is fed next step
         return idx
 
 device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
@@ -264,9 +319,23 @@ model = GPTLanguageModel(vocab_size, n_embd, block_size, n_layers, n_heads, devi
 # Move the model to the GPU (if available)
 model = model.to(device)
 
-# Define criterion and optimizer
+# Regional compilation: compile each transformer block instead of the
+# whole model. The compiled artifact is shared across the identical
+# blocks, so cold start is far lower, and generate's growing KV-cache
+# shapes don't invalidate a whole-model graph. Default mode (no CUDA
+# graphs): the blocks run under gradient checkpointing, and replaying
+# CUDA graphs from inside checkpointed re-forwards can clobber the
+# saved inputs of neighbouring blocks.
+for blk in model.blocks:
+    blk.compile()
+
+# Define criterion and optimizer; fused AdamW updates every parameter
+# in a single kernel and actually applies the decoupled weight_decay
 criterion = nn.CrossEntropyLoss()
-optimizer = optim.Adam(model.parameters(), lr=learning_rate)
+optimizer = optim.AdamW(
+    model.parameters(), lr=learning_rate, weight_decay=weight_decay,
+    betas=(0.9, 0.95), fused=True,
+)
 
 # Training loop with progress reporting
 def batch_gh(model, criterion, optimizer, train_loader, test_loader, epochs):
@@ -276,50 +345,59 @@ def batch_gh(model, criterion, optimizer, train_loader, test_loader, epochs):
     for it in range(epochs):
         model.train()  # Set model to training mode
         t0 = datetime.now()
-        train_loss = []
+        # Accumulate the loss on device; .item() would force a GPU->CPU
+        # sync every batch
+        train_loss_sum = torch.zeros((), device=device)
+        n_train_batches = 0
 
         for i, batch in enumerate(train_loader):
-            inputs = batch["input_ids"].to(device)
-            attention_mask = batch["attention_mask"].to(device)
+            inputs = batch["input_ids"].to(device, non_blocking=True)
 
             # Create targets by shifting inputs by one position
             targets = inputs[:, 1:].contiguous()
             inputs = inputs[:, :-1].contiguous()
 
-            # Zero parameter gradients
-            optimizer.zero_grad()
+            # Zero parameter gradients (set_to_none skips the memset)
+            optimizer.zero_grad(set_to_none=True)
 
-            # Forward pass
-            outputs, loss = model(inputs, targets)
+            # Forward pass in BF16 on GPU; BF16 keeps the FP32 exponent
+            # range, so no GradScaler is needed
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=(device.type == 'cuda')):
+                outputs, loss = model(inputs, targets)
 
-            # Backward and optimize
+            # Backward and optimize; clip gradients with a single
+            # multi-tensor norm kernel to keep BF16 training stable
             loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0, foreach=True)
             optimizer.step()
 
-            train_loss.append(loss.item())
+            train_loss_sum += loss.detach()
+            n_train_batches += 1
 
-            # Print progress every 100 batches
+            # Print progress every 100 batches (intentional sync point)
             if (i + 1) % 100 == 0:
-                print(f'Epoch {it + 1}/{epochs}, Batch {i + 1}/{len(train_loader)}, Loss: {loss.item():.4f}')
+                print(f'Epoch {it + 1}/{epochs}, Batch {i + 1}/{len(train_loader)}, Loss: {loss.detach().item():.4f}')
 
-        # Get average train_loss
-        train_loss = np.mean(train_loss)
+        # Get average train_loss (single sync per epoch)
+        train_loss = (train_loss_sum / n_train_batches).item()
 
         model.eval()  # Set model to evaluation mode
-        test_loss = []
+        test_loss_sum = torch.zeros((), device=device)
+        n_test_batches = 0
         with torch.no_grad():
             for batch in test_loader:
-                inputs = batch["input_ids"].to(device)
-                attention_mask = batch["attention_mask"].to(device)
+                inputs = batch["input_ids"].to(device, non_blocking=True)
 
                 # Create targets by shifting inputs by one position
                 targets = inputs[:, 1:].contiguous()
                 inputs = inputs[:, :-1].contiguous()
 
-                outputs, loss = model(inputs, targets)
-                test_loss.append(loss.item())
+                with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=(device.type == 'cuda')):
+                    outputs, loss = model(inputs, targets)
+                test_loss_sum += loss.detach()
+                n_test_batches += 1
 
-            test_loss = np.mean(test_loss)
+            test_loss = (test_loss_sum / n_test_batches).item()
 
         # Save losses
         train_losses[it] = train_loss
@@ -1,5 +1,8 @@
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+import math
 from transformers import GPT2Tokenizer
 import tiktoken  # Make sure tiktoken is imported
 
@@ -10,53 +13,53 @@ tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
 
 # Define the GPTLanguageModel class (the one you used for training)
 # Ensure that this matches exactly the training-time definition
-class Head(nn.Module):
-    def __init__(self, head_size, n_embd, block_size, dropout):
+class RMSNorm(nn.Module):
+    def __init__(self, dim, eps=1e-6):
         super().__init__()
-        self.key = nn.Linear(n_embd, head_size, bias=False)
-        self.query = nn.Linear(n_embd, head_size, bias=False)
-        self.value = nn.Linear(n_embd, head_size, bias=False)
-        self.register_buffer("tril", torch.tril(torch.ones(block_size, block_size)))
-        self.dropout = nn.Dropout(dropout)
+        self.weight = nn.Parameter(torch.ones(dim))
+        self.eps = eps
 
     def forward(self, x):
-        B, T, C = x.shape
-        k = self.key(x)
-        q = self.query(x)
-        v = self.value(x)
-        wei = q @ k.transpose(-2, -1) * k.shape[-1]**-0.5
-        wei = wei.masked_fill(self.tril[:T, :T] == 0, float('-inf'))
-        wei = F.softmax(wei, dim=-1)
-        wei = self.dropout(wei)
-        out = wei @ v
-        return out
+        return F.rms_norm(x, (x.shape[-1],), self.weight, self.eps)
 
 class MultiHeadAttention(nn.Module):
     def __init__(self, n_heads, head_size, n_embd, dropout):
         super().__init__()
-        self.heads = nn.ModuleList([Head(head_size, n_embd, block_size, dropout) for _ in range(n_heads)])
+        self.n_heads = n_heads
+        self.head_size = head_size
+        self.qkv = nn.Linear(n_embd, 3 * n_embd, bias=False)
         self.proj = nn.Linear(n_heads * head_size, n_embd)
+        self.proj._is_residual_proj = True
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x):
-        head_outputs = [head(x) for head in self.heads]
-        concatenated = torch.cat(head_outputs, dim=-1)
-        out = self.proj(concatenated)
-        out = self.dropout(out)
-        return out
+    def forward(self, x, past_kv=None, use_cache=False):
+        B, T, C = x.shape
+        qkv = self.qkv(x).view(B, T, 3, self.n_heads, self.head_size).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        if past_kv is not None:
+            assert T == 1, f"KV-cached attention expects one new token at a time, got {T}"
+            past_k, past_v = past_kv
+            k = torch.cat((past_k, k), dim=2)
+            v = torch.cat((past_v, v), dim=2)
+        out = F.scaled_dot_product_attention(
+            q, k, v,
+            dropout_p=self.dropout.p if self.training else 0.0,
+            is_causal=past_kv is None,
+        )
+        out = out.transpose(1, 2).reshape(B, T, C)
+        return self.dropout(self.proj(out)), ((k, v) if use_cache else None)
 
 class FeedForward(nn.Module):
     def __init__(self, n_embd, dropout=0.1, expansion_factor=4):
         super().__init__()
-        self.net = nn.Sequential(
-            nn.Linear(n_embd, expansion_factor * n_embd),
-            nn.ReLU(),
-            nn.Linear(expansion_factor * n_embd, n_embd),
-            nn.Dropout(dropout),
-        )
+        self.w_gate_up = nn.Linear(n_embd, 2 * expansion_factor * n_embd, bias=False)
+        self.w_down = nn.Linear(expansion_factor * n_embd, n_embd, bias=False)
+        self.w_down._is_residual_proj = True
+        self.drop = nn.Dropout(dropout)
 
     def forward(self, x):
-        return self.net(x)
+        gate, up = self.w_gate_up(x).chunk(2, dim=-1)
+        return self.drop(self.w_down(F.silu(gate) * up))
 
 class Block(nn.Module):
     def __init__(self, n_embd, n_head, dropout=0.1):
@@ -64,62 +67,81 @@ class Block(nn.Module):
         head_size = n_embd // n_head
         self.sa = MultiHeadAttention(n_head, head_size, n_embd, dropout)
         self.ffwd = FeedForward(n_embd, dropout)
-        self.ln1 = nn.LayerNorm(n_embd)
-        self.ln2 = nn.LayerNorm(n_embd)
+        self.ln1 = RMSNorm(n_embd)
+        self.ln2 = RMSNorm(n_embd)
 
-    def forward(self, x):
-        x = x + self.sa(self.ln1(x))
+    def forward(self, x, past_kv=None, use_cache=False):
+        attn_out, new_kv = self.sa(self.ln1(x), past_kv, use_cache)
+        x = x + attn_out
         x = x + self.ffwd(self.ln2(x))
-        return x
+        return x, new_kv
 
 class GPTLanguageModel(nn.Module):
     def __init__(self, vocab_size, n_embd, block_size, n_layer, n_head, device="cpu"):
         super().__init__()
         self.device = device
         self.block_size = block_size
+        self.n_layer = n_layer
         self.token_embedding_table = nn.Embedding(vocab_size, n_embd)
         self.position_embedding_table = nn.Embedding(block_size, n_embd)
-        self.blocks = nn.Sequential(*[Block(n_embd, n_head) for _ in range(n_layer)])
-        self.ln_f = nn.LayerNorm(n_embd)
-        self.lm_head = nn.Linear(n_embd, vocab_size)
+        self.blocks = nn.ModuleList([Block(n_embd, n_head) for _ in range(n_layer)])
+        self.ln_f = RMSNorm(n_embd)
+        self.lm_head = nn.Linear(n_embd, vocab_size, bias=False)
+        self.register_buffer('pos_ids', torch.arange(block_size), persistent=False)
         self.apply(self._init_weights)
+        self.lm_head.weight = self.token_embedding_table.weight
 
     def _init_weights(self, module):
-        if isinstance(module, nn.Linear):
-            nn.init.normal_(module.weight, mean=0.0, std=0.02)
-            if module.bias is not None:
+        if isinstance(module, (nn.Linear, nn.Embedding)):
+            std = 0.02
+            if getattr(module, '_is_residual_proj', False):
+                std = 0.02 / math.sqrt(2 * self.n_layer)
+            nn.init.trunc_normal_(module.weight, mean=0.0, std=std)
+            if isinstance(module, nn.Linear) and module.bias is not None:
                 nn.init.zeros_(module.bias)
-        elif isinstance(module, nn.Embedding):
-            nn.init.normal_(module.weight, mean=0.1, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, past_kvs=None):
         B, T = idx.shape
         T = min(T, self.block_size)
         idx = idx[:, :T]
+        past_len = 0 if past_kvs is None or past_kvs[0] is None else past_kvs[0][0].shape[2]
         tok_emb = self.token_embedding_table(idx)
-        pos_emb = self.position_embedding_table(torch.arange(T, device=idx.device))
+        pos_emb = self.position_embedding_table(self.pos_ids[past_len:past_len + T])
         x = tok_emb + pos_emb.unsqueeze(0)
-        x = self.blocks(x)
+        use_cache = past_kvs is not None
+        new_kvs = []
+        for block, past_kv in zip(self.blocks, past_kvs if use_cache else [None] * len(self.blocks)):
+            if self.training:
+                x, kv = checkpoint(block, x, past_kv, use_cache, use_reentrant=False)
+            else:
+                x, kv = block(x, past_kv, use_cache)
+            if use_cache:
+                new_kvs.append(kv)
         x = self.ln_f(x)
         logits = self.lm_head(x)
         loss = None
         if targets is not None:
             targets = targets[:, :T]
-            B, T, C = logits.shape
-            logits = logits.reshape(B*T, C)
-            targets = targets.reshape(B*T)
-            loss = F.cross_entropy(logits, targets)
-        return logits, loss
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1))
+        if past_kvs is None:
+            return logits, loss
+        return logits, loss, new_kvs
 
     @torch.no_grad()
     def generate(self, idx, max_new_tokens):
+        past_kvs = [None] * len(self.blocks)
+        idx_cond = idx[:, -self.block_size:]
         for _ in range(max_new_tokens):
-            idx_cond = idx[:, -self.block_size:]
-            logits, _ = self(idx_cond)
+            logits, _, past_kvs = self(idx_cond, past_kvs=past_kvs)
             logits = logits[:, -1, :]
             probs = F.softmax(logits, dim=-1)
             idx_next = torch.multinomial(probs, num_samples=1)
             idx = torch.cat((idx, idx_next), dim=1)
+            if past_kvs[0][0].shape[2] >= self.block_size:
+                past_kvs = [None] * len(self.blocks)
+                idx_cond = idx[:, -self.block_size:]
+            else:
+                idx_cond = idx_next
         return idx
 
 # Now that we have the model definition, let's load the weights and perform inference